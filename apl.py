@@ -1,15 +1,63 @@
 import streamlit as st
 import pandas as pd
-from PIL import Image
+import numpy as np
+import pyarrow.csv as pac
 import os
+import json
+from collections import OrderedDict
+from label_common import (CSV_CONVERT_OPTIONS, LABEL_COLUMNS, PREFETCH_AHEAD, coerce_label_columns,
+                          show_image, start_image)
 
 # Define the paths to your local files
 images_folder = "Chunk1"  # Path to your images folder (update as needed)
 csv_file_path = "chunk_1.csv"  # Path to your CSV file (update as needed)
+labels_log_path = "chunk_1_labels.jsonl"  # Append-only log of label edits not yet folded into the CSV
+LOG_COMPACT_THRESHOLD = 50  # Rewrite the CSV once this many edits are pending in the log
 
-# Load metadata (GT_Pneumothorax.csv)
+# Parse the CSV once per file version instead of on every rerun
+@st.cache_data(show_spinner=False, max_entries=1)
+def _load_csv_local(path, mtime):
+    return coerce_label_columns(pac.read_csv(path, convert_options=CSV_CONVERT_OPTIONS).to_pandas())
+
+def _apply_labels(df, recs):
+    """Apply logged edits ({idx, type, size, side, drop}) to the DataFrame, later edits winning."""
+    log = pd.DataFrame(recs)
+    # A drop only sets Label_Flag/Drop, so each row keeps the values of its last real label
+    labels = log[~log["drop"]].drop_duplicates("idx", keep="last")
+    rows = labels["idx"].to_numpy()
+    for col, key in zip(LABEL_COLUMNS, ["type", "size", "side"]):
+        df.loc[rows, col] = labels[key].to_numpy()
+    df.loc[rows, ["Label_Flag", "Drop"]] = [1, "False"]
+    last = log.drop_duplicates("idx", keep="last")
+    df.loc[last.loc[last["drop"], "idx"], ["Label_Flag", "Drop"]] = [1, "True"]
+
+# Replay the log once per (CSV, log) version rather than on every rerun; a save changes
+# the log's mtime, so only saves pay for the replay
+@st.cache_data(show_spinner=False, max_entries=1)
+def _load_labels(csv_path, csv_mtime, log_path, log_mtime):
+    """Return the CSV with the pending log applied, and the number of pending edits."""
+    df = _load_csv_local(csv_path, csv_mtime)
+    if log_mtime is None:
+        return df, 0
+    with open(log_path) as f:
+        recs = [json.loads(line) for line in f if line.strip()]
+    if recs:
+        _apply_labels(df, recs)
+    return df, len(recs)
+
+def save_label(df, rec, pending):
+    """Append the edit to the log; fold the log into the CSV once it grows large."""
+    with open(labels_log_path, "a") as f:
+        f.write(json.dumps(rec) + "\n")
+    _apply_labels(df, [rec])
+    if pending + 1 >= LOG_COMPACT_THRESHOLD:
+        df.to_csv(csv_file_path, index=False)
+        os.remove(labels_log_path)
+
+# Load metadata (GT_Pneumothorax.csv) and replay pending edits on top of it
 try:
-    GT_Pneumothorax = pd.read_csv(csv_file_path)
+    log_mtime = os.stat(labels_log_path).st_mtime_ns if os.path.exists(labels_log_path) else None
+    GT_Pneumothorax, n_pending = _load_labels(csv_file_path, os.path.getmtime(csv_file_path), labels_log_path, log_mtime)
 except Exception as e:
     st.error(f"Failed to load metadata: {e}")
     st.stop()
@@ -17,39 +65,35 @@ except Exception as e:
 # App title
 st.title("Pneumothorax Grading and Image Viewer")
 
-# Initialize session state for the current index
-if "current_index" not in st.session_state:
-    st.session_state.current_index = 0
-
-# Loop to skip labeled images automatically
-while st.session_state.current_index < len(GT_Pneumothorax):
-    row = GT_Pneumothorax.iloc[st.session_state.current_index]
-    if row["Label_Flag"] == 1:
-        st.session_state.current_index += 1  # Skip labeled images
-    else:
-        break
+# Build the sorted queue of unlabeled row positions once per session (labeled rows are skipped)
+if "queue" not in st.session_state:
+    st.session_state.queue = np.flatnonzero(GT_Pneumothorax["Label_Flag"].to_numpy() != 1)
+    st.session_state.qpos = 0
+    st.session_state.img_cache = OrderedDict()
+    # Identity columns never change, so keep them as plain arrays instead of slicing rows
+    st.session_state.col_name = GT_Pneumothorax["Image_Name"].to_numpy()
+    st.session_state.col_index = GT_Pneumothorax["Index"].to_numpy()
+    # O(1) Image_Name -> row position lookup, robust to the CSV being reordered
+    st.session_state.name_to_pos = dict(zip(st.session_state.col_name, range(len(GT_Pneumothorax))))
 
 # Ensure there are still images left to process
-if st.session_state.current_index >= len(GT_Pneumothorax):
+if len(st.session_state.queue) == 0:
     st.success("All images have been labeled! No more images to process.")
     st.stop()
 
 # Get the current row (image and metadata)
-row = GT_Pneumothorax.iloc[st.session_state.current_index]
+csv_idx = int(st.session_state.queue[st.session_state.qpos])
+img_name = st.session_state.col_name[csv_idx]
 
 # Get the current image path (based on Image_Name)
-image_path = os.path.join(images_folder, row["Image_Name"])
+image_path = os.path.join(images_folder, img_name)
 
 # Check if the image file exists and display it
 if os.path.exists(image_path):
-    img = Image.open(image_path)
-    st.image(
-        img,
-        caption=f"Image index: {row['Index']} | Image Name: {row['Image_Name']}",
-        use_column_width=True
-    )
+    upcoming = st.session_state.queue[st.session_state.qpos + 1:st.session_state.qpos + 1 + PREFETCH_AHEAD]
+    image_future, image_slot = start_image(images_folder, img_name, st.session_state.col_name[upcoming])
 else:
-    st.error(f"Image {row['Image_Name']} not found in {images_folder}.")
+    st.error(f"Image {img_name} not found in {images_folder}.")
     st.stop()
 
 # Handling user input for Pneumothorax type and measurements
@@ -60,33 +104,34 @@ Affected_Side = st.selectbox("Affected Side", ["Right", "Left"], index=0)
 
 # Checkbox to save changes
 save_changes = st.button("Save Changes")
-if drop_checkbox:
-    GT_Pneumothorax.at[st.session_state.current_index, "Label_Flag"] = 1
-    GT_Pneumothorax.at[st.session_state.current_index, "Drop"] = drop_checkbox
+if drop_checkbox or save_changes:
+    rec = {
+        "idx": st.session_state.name_to_pos[img_name],
+        "type": pneumothorax_type,
+        "size": pneumothorax_Size,
+        "side": Affected_Side,
+        "drop": bool(drop_checkbox),
+    }
     try:
-        GT_Pneumothorax.to_csv(csv_file_path, index=False)
-        st.success(f"Changes saved for Image {row['Image_Name']}!")
-    except Exception as e:
-        st.error(f"Failed to save changes: {e}")
-# Mark as labeled
-elif save_changes:
-    # Update the metadata locally
-    GT_Pneumothorax.at[st.session_state.current_index, "Pneumothorax_Type"] = pneumothorax_type
-    GT_Pneumothorax.at[st.session_state.current_index, "Pneumothorax_Size"] = pneumothorax_Size
-    GT_Pneumothorax.at[st.session_state.current_index, "Affected_Side"] = Affected_Side
-    GT_Pneumothorax.at[st.session_state.current_index, "Label_Flag"] = 1  # Mark as labeled
-    GT_Pneumothorax.at[st.session_state.current_index, "Drop"] = "False"
-
-    # Save the updated CSV locally
-    try:
-        GT_Pneumothorax.to_csv(csv_file_path, index=False)
-        st.success(f"Changes saved for Image {row['Image_Name']}!")
+        save_label(GT_Pneumothorax, rec, n_pending)
+        st.success(f"Changes saved for Image {img_name}!")
+        # Remove the labeled row from the queue; the pointer now refers to the next one
+        st.session_state.queue = np.delete(st.session_state.queue, st.session_state.qpos)
+        st.session_state.qpos = max(0, min(st.session_state.qpos, len(st.session_state.queue) - 1))
     except Exception as e:
         st.error(f"Failed to save changes: {e}")
 
 # Navigation buttons (Previous / Next)
 col1, col2 = st.columns(2)
-if col1.button("Previous") and st.session_state.current_index > 0:
-    st.session_state.current_index -= 1
-if col2.button("Next") and st.session_state.current_index < len(GT_Pneumothorax) - 1:
-    st.session_state.current_index += 1
+if col1.button("Previous") and st.session_state.qpos > 0:
+    st.session_state.qpos -= 1
+if col2.button("Next") and st.session_state.qpos < len(st.session_state.queue) - 1:
+    st.session_state.qpos += 1
+
+# Jump to the first unlabeled image at or after a given CSV row (binary search on the sorted queue)
+jump_row = st.number_input("Jump to CSV row", min_value=0, max_value=len(GT_Pneumothorax) - 1, step=1)
+if st.button("Jump"):
+    st.session_state.qpos = min(int(np.searchsorted(st.session_state.queue, jump_row)), len(st.session_state.queue) - 1)
+
+# Render the image into its placeholder now that the widgets are built
+show_image(image_future, image_slot, caption=f"Image index: {st.session_state.col_index[csv_idx]} | Image Name: {img_name}")
@@ -1,49 +1,227 @@
 import streamlit as st
-import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pac
 from PIL import Image
-from github import Github
+from github import Auth, Github, GithubException, GithubRetry
 import os
 import io
+import json
+import base64
 import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+from label_common import (CSV_CONVERT_OPTIONS, LABEL_COLUMNS, PREFETCH_AHEAD, coerce_label_columns,
+                          show_image, start_image)
 
 # --- GitHub Setup ---
 GITHUB_TOKEN = st.secrets["GITHUB_TOKEN"]
-g = Github(GITHUB_TOKEN)
 REPO_NAME = "Abdullahshade/repotwoforpen"
 FILE_PATH = "chunk_2.csv"
 images_folder = "chunk2"
+PENDING_LOG_PATH = "chunk_2_pending.jsonl"  # Local copy of labels not yet pushed, survives a browser refresh
+SYNC_THRESHOLD = 20  # Push to GitHub automatically once this many labels are pending
+
+# Build the client and repo handle once per server process; get_repo() is itself an API call
+@st.cache_resource(show_spinner=False)
+def get_repo():
+    return Github(auth=Auth.Token(GITHUB_TOKEN), per_page=100, retry=GithubRetry(total=3)).get_repo(REPO_NAME)
 
 # --- Load Data with Validation ---
+# Keep the ContentFile around so later checks are conditional (ETag) requests;
+# GitHub answers 304 when the file is unchanged, which doesn't count against the rate limit
+@st.cache_resource(show_spinner=False)
+def _csv_contents():
+    # The ContentFile is shared by every session and updated in place, hence the lock
+    return get_repo().get_contents(FILE_PATH), threading.Lock()
+
+def get_csv_snapshot():
+    """Current (sha, body) of the CSV on GitHub, refreshed with a conditional request.
+
+    The body is None when the contents API left it out (files over 1 MB).
+    """
+    contents, lock = _csv_contents()
+    with lock:
+        contents.update()
+        return contents.sha, contents.decoded_content if contents.encoding == "base64" else None
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def _parse_csv(sha, _body):
+    """Parse the CSV once per blob sha; the body itself is not hashed."""
+    if _body is None:
+        # The contents API leaves out the body of files over 1 MB; the blob API has no such limit
+        _body = base64.b64decode(get_repo().get_git_blob(sha).content)
+    return pac.read_csv(pa.BufferReader(_body), convert_options=CSV_CONVERT_OPTIONS).to_pandas()
+
 def load_data():
     try:
-        repo = g.get_repo(REPO_NAME)
-        contents = repo.get_contents(FILE_PATH)
-        csv_content = contents.decoded_content
-        df = pd.read_csv(io.BytesIO(csv_content))
+        sha, body = get_csv_snapshot()
+        df = _parse_csv(sha, body)
+        st.session_state.last_sha = sha
         
         # Validate critical columns
         required_columns = ["Index", "Image_Name", "Label_Flag"]
         if not all(col in df.columns for col in required_columns):
             st.error(f"CSV missing required columns: {required_columns}")
             st.stop()
-            
+        
+        coerce_label_columns(df)
         return df
     except Exception as e:
         st.error(f"Error loading data: {e}")
         st.stop()
 
-GT_Pneumothorax = load_data()
+def _probe(path):
+    """Read only the image header (no pixel decode) and return its (width, height)."""
+    with Image.open(path) as im:
+        return im.size
+
+# --- Pending Edits Log ---
+# Unpushed labels are also appended to a local JSONL file, so a browser refresh (which clears
+# session_state) doesn't lose them. The file is shared by every session on the server, so each
+# record carries its labeler id, kept in the URL so it survives the refresh
+def get_labeler_id():
+    if "labeler" not in st.query_params:
+        st.query_params["labeler"] = uuid.uuid4().hex
+    return st.query_params["labeler"]
+
+@st.cache_resource
+def _pending_log_lock():
+    return threading.Lock()
+
+def log_edit(rec):
+    with _pending_log_lock():
+        with open(PENDING_LOG_PATH, "a") as f:
+            f.write(json.dumps(rec) + "\n")
+
+def read_pending_log(labeler):
+    """Unpushed edits written by ``labeler``; other labelers' records are left alone."""
+    with _pending_log_lock():
+        if not os.path.exists(PENDING_LOG_PATH):
+            return []
+        with open(PENDING_LOG_PATH) as f:
+            recs = [json.loads(line) for line in f if line.strip()]
+    return [rec for rec in recs if rec.get("labeler") == labeler]
+
+def unlog_edits(recs):
+    """Remove pushed edits from the log, keeping any written by other sessions."""
+    with _pending_log_lock():
+        if not os.path.exists(PENDING_LOG_PATH):
+            return
+        with open(PENDING_LOG_PATH) as f:
+            remaining = [line for line in f if line.strip() and json.loads(line) not in recs]
+        if remaining:
+            with open(PENDING_LOG_PATH, "w") as f:
+                f.writelines(remaining)
+        else:
+            os.remove(PENDING_LOG_PATH)
+
+def apply_edits(df, edits):
+    """Apply label edits ({Image_Name, type, size, side, drop}) to ``df``, matching rows by name."""
+    name_to_pos = dict(zip(df["Image_Name"].to_numpy(), range(len(df))))
+    for rec in edits:
+        pos = name_to_pos.get(rec["Image_Name"])
+        if pos is not None:
+            df.loc[pos, LABEL_COLUMNS] = [rec["type"], rec["size"], rec["side"], 1, "True" if rec["drop"] else "False"]
+    return df
+
+def adopt_frame(df):
+    """Make ``df`` the session's DataFrame and rebuild the lookups and queue that point into it."""
+    current = None
+    if st.session_state.get("current_pos", -1) >= 0:
+        current = st.session_state.col_name[st.session_state.unlabeled_indices[st.session_state.current_pos]]
+    st.session_state.GT_Pneumothorax = df
+    # Image_Name never changes, so keep it as a plain array instead of slicing rows, plus an
+    # O(1) Image_Name -> row position lookup that is robust to the CSV being reordered
+    st.session_state.col_name = df["Image_Name"].to_numpy()
+    st.session_state.name_to_pos = dict(zip(st.session_state.col_name, range(len(df))))
+    flags = df["Label_Flag"].to_numpy(dtype=np.int8, copy=False)
+    st.session_state.unlabeled_indices = np.flatnonzero(flags == 0).tolist()
+    # Stay on the same image if it is still unlabeled in the new frame
+    pos = st.session_state.name_to_pos.get(current)
+    if pos in st.session_state.unlabeled_indices:
+        st.session_state.current_pos = st.session_state.unlabeled_indices.index(pos)
+    elif st.session_state.unlabeled_indices:
+        st.session_state.current_pos = min(max(st.session_state.get("current_pos", 0), 0), len(st.session_state.unlabeled_indices)-1)
+    else:
+        st.session_state.current_pos = -1
+
+def reload_data():
+    """Load the latest CSV from GitHub and replay this session's unpushed edits on top of it."""
+    adopt_frame(apply_edits(load_data(), st.session_state.pending_edits))
 
 # --- Session State Setup ---
-if "unlabeled_indices" not in st.session_state:
-    GT_Pneumothorax["Label_Flag"] = pd.to_numeric(GT_Pneumothorax["Label_Flag"], errors="coerce").fillna(0)
-    st.session_state.unlabeled_indices = GT_Pneumothorax.index[GT_Pneumothorax["Label_Flag"] == 0].tolist()
-    st.session_state.current_pos = 0 if st.session_state.unlabeled_indices else -1
+# The in-memory DataFrame is authoritative between syncs; edits are pushed in batches
+if "GT_Pneumothorax" not in st.session_state:
+    st.session_state.img_cache = OrderedDict()
+    st.session_state.labeler = get_labeler_id()
+    st.session_state.pending_edits = read_pending_log(st.session_state.labeler)
+    reload_data()
+    if st.session_state.pending_edits:
+        st.info(f"Restored {len(st.session_state.pending_edits)} label(s) not yet pushed to GitHub")
+GT_Pneumothorax = st.session_state.GT_Pneumothorax
 
-# --- Reset Button ---
-if st.button("⟳ Reset App State"):
+# --- GitHub Sync ---
+def update_system():
+    """Push all pending label edits to GitHub in a single commit."""
+    try:
+        n_edits = len(st.session_state.pending_edits)
+        for attempt in range(3):
+            # Write straight into a bytes buffer rather than building a str and encoding it
+            buf = io.BytesIO()
+            st.session_state.GT_Pneumothorax.to_csv(buf, index=False, encoding="utf-8")
+            try:
+                # Push against the version this frame was loaded from, so GitHub rejects
+                # the commit if someone else pushed in the meantime
+                result = get_repo().update_file(FILE_PATH, f"Updated labels ({n_edits} images)", buf.getvalue(), st.session_state.last_sha)
+                break
+            except GithubException as e:
+                if e.status != 409 or attempt == 2:
+                    raise
+                # Someone else pushed first: rebase our edits onto their version and retry
+                reload_data()
+        st.session_state.last_sha = result["content"].sha
+        unlog_edits(st.session_state.pending_edits)
+        st.session_state.pending_edits = []
+        
+        # Update session state from the in-memory copy; it is exactly what we just pushed
+        flags = st.session_state.GT_Pneumothorax["Label_Flag"].to_numpy(dtype=np.int8, copy=False)
+        st.session_state.unlabeled_indices = np.flatnonzero(flags == 0).tolist()
+        if not st.session_state.unlabeled_indices:
+            st.session_state.current_pos = -1
+        else:
+            st.session_state.current_pos = min(max(st.session_state.current_pos, 0), len(st.session_state.unlabeled_indices)-1)
+        
+        return True
+    except Exception as e:
+        st.error(f"Save failed: {e}")
+        return False
+
+# --- Button Callbacks ---
+# State changes happen in on_click callbacks, which run before the next rerun, so each
+# click costs one script execution instead of an extra st.rerun() round
+def reset_app():
+    # Don't lose labels that haven't been pushed yet
+    if st.session_state.pending_edits and not update_system():
+        return
     st.session_state.clear()
-    st.rerun()
+
+def sync_now():
+    n_pending = len(st.session_state.pending_edits)
+    if update_system():
+        st.success(f"Synced {n_pending} labels to GitHub")
+
+def go_previous():
+    if st.session_state.current_pos > 0:
+        st.session_state.current_pos -= 1
+
+def go_next():
+    if st.session_state.current_pos < len(st.session_state.unlabeled_indices)-1:
+        st.session_state.current_pos += 1
+
+# --- Reset Button ---
+st.button("⟳ Reset App State", on_click=reset_app)
 
 # --- Get Current Image with Verification ---
 def get_current_image():
@@ -52,18 +230,22 @@ def get_current_image():
     
     try:
         csv_idx = st.session_state.unlabeled_indices[st.session_state.current_pos]
-        row = GT_Pneumothorax.iloc[csv_idx]
-        image_path = os.path.join(images_folder, row["Image_Name"])
+        img_name = st.session_state.col_name[csv_idx]
+        image_path = os.path.join(images_folder, img_name)
         
         # Verify image existence and index consistency
         if not os.path.exists(image_path):
-            st.error(f"Image mismatch! CSV Index: {csv_idx} | Image: {row['Image_Name']} not found")
+            st.error(f"Image mismatch! CSV Index: {csv_idx} | Image: {img_name} not found")
             return None
-            
-        return (csv_idx, row, Image.open(image_path))
+        
+        # Pixels are only decoded when the image is actually rendered
+        return (csv_idx, img_name, image_path, _probe(image_path))
     except (IndexError, KeyError) as e:
         st.error(f"Index error: {e}")
         return None
+    except OSError as e:
+        st.error(f"Unreadable image! CSV Index: {csv_idx} | Image: {img_name} ({e})")
+        return None
 
 # --- Display Current Image with Metadata ---
 current_image = get_current_image()
@@ -72,7 +254,7 @@ if not current_image:
     st.warning("No images available for labeling!")
     st.stop()
 
-csv_idx, row, img = current_image
+csv_idx, img_name, image_path, img_size = current_image
 
 # Display verification info
 st.subheader(f"Image Details")
@@ -80,105 +262,101 @@ col1, col2 = st.columns(2)
 with col1:
     st.metric("CSV Index", csv_idx)
 with col2:
-    st.metric("Image Name", row["Image_Name"])
+    st.metric("Image Name", img_name)
     
-st.image(img, use_column_width=True)
+pos = st.session_state.current_pos
+upcoming = st.session_state.unlabeled_indices[pos + 1:pos + 1 + PREFETCH_AHEAD]
+image_future, image_slot = start_image(images_folder, img_name, st.session_state.col_name[upcoming])
 
 # --- Checksum Verification ---
-def get_image_checksum(image_path):
+@st.cache_data(show_spinner=False)
+def _checksum(image_path, mtime_ns, size):
     with open(image_path, "rb") as f:
         return hashlib.md5(f.read()).hexdigest()
 
-current_checksum = get_image_checksum(os.path.join(images_folder, row["Image_Name"]))
+def get_image_checksum(image_path):
+    """MD5 of the image, only recomputed when the file's mtime or size changes."""
+    stat = os.stat(image_path)
+    return _checksum(image_path, stat.st_mtime_ns, stat.st_size)
+
+current_checksum = get_image_checksum(image_path)
 st.caption(f"Image Checksum: `{current_checksum}`")
 
+# --- Save/Drop Handler ---
+def save_label(img_name, drop):
+    # img_name comes from col_name, which name_to_pos is built from, so the lookup always hits
+    pos = st.session_state.name_to_pos[img_name]
+    
+    # Keep the full edit so it can be replayed onto a newer CSV if the push conflicts
+    rec = {
+        "labeler": st.session_state.labeler,
+        "Image_Name": img_name,
+        "type": st.session_state.pneumothorax_type,
+        "size": st.session_state.pneumothorax_size,
+        "side": st.session_state.affected_side,
+        "drop": drop,
+    }
+    log_edit(rec)
+    st.session_state.pending_edits.append(rec)
+    
+    # Update DataFrame
+    st.session_state.GT_Pneumothorax.loc[pos, LABEL_COLUMNS] = [rec["type"], rec["size"], rec["side"], 1, "True" if drop else "False"]
+    st.success(f"Saved: Index {pos} | {img_name}")
+    
+    # Move on to the next unlabeled image without waiting for GitHub
+    st.session_state.unlabeled_indices.pop(st.session_state.current_pos)
+    if not st.session_state.unlabeled_indices:
+        st.session_state.current_pos = -1
+    else:
+        st.session_state.current_pos = min(st.session_state.current_pos, len(st.session_state.unlabeled_indices)-1)
+    
+    if len(st.session_state.pending_edits) >= SYNC_THRESHOLD or st.session_state.current_pos == -1:
+        update_system()
+
 # --- Grading Form ---
 with st.form(key="grading_form"):
     st.subheader("Labeling Interface")
     
-    # Get current values with fallbacks
-    current_type = row.get("Pneumothorax_Type", "Simple")
-    current_size = row.get("Pneumothorax_Size", "Small")
-    current_side = row.get("Affected_Side", "Right")
-
-    pneumothorax_type = st.selectbox("Pneumothorax Type", ["Simple", "Tension"], 
-                                   index=0 if current_type == "Simple" else 1)
-    pneumothorax_size = st.selectbox("Pneumothorax Size", ["Small", "Large"], 
-                                   index=0 if current_size == "Small" else 1)
-    affected_side = st.selectbox("Affected Side", ["Right", "Left"], 
-                               index=0 if current_side == "Right" else 1)
+    # Get current values (missing label columns are created at load)
+    current_type = GT_Pneumothorax.at[csv_idx, "Pneumothorax_Type"]
+    current_size = GT_Pneumothorax.at[csv_idx, "Pneumothorax_Size"]
+    current_side = GT_Pneumothorax.at[csv_idx, "Affected_Side"]
+
+    st.selectbox("Pneumothorax Type", ["Simple", "Tension"], key="pneumothorax_type",
+                 index=0 if current_type == "Simple" else 1)
+    st.selectbox("Pneumothorax Size", ["Small", "Large"], key="pneumothorax_size",
+                 index=0 if current_size == "Small" else 1)
+    st.selectbox("Affected Side", ["Right", "Left"], key="affected_side",
+                 index=0 if current_side == "Right" else 1)
 
     col1, col2 = st.columns([1, 3])
     with col1:
-        form_submit = st.form_submit_button("💾 Save")
+        st.form_submit_button("💾 Save", on_click=save_label, args=(img_name, False))
     with col2:
-        drop_submit = st.form_submit_button("🗑️ Drop")
-
-# --- Save/Drop Handler with Verification ---
-def verify_before_save(original_idx, original_name):
-    """Ensure CSV hasn't changed since loading"""
-    try:
-        current_row = GT_Pneumothorax.iloc[original_idx]
-        return current_row["Image_Name"] == original_name
-    except:
-        return False
-
-def update_system():
-    try:
-        # Update GitHub
-        repo = g.get_repo(REPO_NAME)
-        contents = repo.get_contents(FILE_PATH)
-        updated_csv = GT_Pneumothorax.to_csv(index=False).encode("utf-8")
-        repo.update_file(contents.path, "Updated labels", updated_csv, contents.sha)
-        
-        # Reload data
-        new_data = load_data()
-        GT_Pneumothorax.update(new_data)
-        
-        # Update session state
-        GT_Pneumothorax["Label_Flag"] = pd.to_numeric(GT_Pneumothorax["Label_Flag"], errors="coerce").fillna(0)
-        st.session_state.unlabeled_indices = GT_Pneumothorax.index[GT_Pneumothorax["Label_Flag"] == 0].tolist()
-        st.session_state.current_pos = 0 if st.session_state.unlabeled_indices else -1
-        
-        return True
-    except Exception as e:
-        st.error(f"Save failed: {e}")
-        return False
+        st.form_submit_button("🗑️ Drop", on_click=save_label, args=(img_name, True))
 
-if form_submit or drop_submit:
-    # Verify integrity before saving
-    if not verify_before_save(csv_idx, row["Image_Name"]):
-        st.error("""Data mismatch detected! 
-                The CSV has changed since loading. Reloading data...""")
-        GT_Pneumothorax = load_data()
-        st.rerun()
-    
-    # Update DataFrame
-    GT_Pneumothorax.at[csv_idx, "Pneumothorax_Type"] = pneumothorax_type
-    GT_Pneumothorax.at[csv_idx, "Pneumothorax_Size"] = pneumothorax_size
-    GT_Pneumothorax.at[csv_idx, "Affected_Side"] = affected_side
-    GT_Pneumothorax.at[csv_idx, "Label_Flag"] = 1
-    GT_Pneumothorax.at[csv_idx, "Drop"] = "True" if drop_submit else "False"
-    
-    if update_system():
-        st.success(f"Saved: Index {csv_idx} | {row['Image_Name']}")
-    st.rerun()
+# --- Sync Controls ---
+n_pending = len(st.session_state.pending_edits)
+st.caption(f"{n_pending} label(s) not yet pushed to GitHub (auto-sync at {SYNC_THRESHOLD})")
+st.button("🔄 Sync to GitHub", disabled=not n_pending, on_click=sync_now)
 
 # --- Navigation Controls ---
 st.subheader("Navigation")
 col_prev, _, col_next = st.columns([1, 2, 1])
 with col_prev:
-    if st.button("⏮️ Previous") and st.session_state.current_pos > 0:
-        st.session_state.current_pos -= 1
-        st.rerun()
+    st.button("⏮️ Previous", on_click=go_previous)
 with col_next:
-    if st.button("⏭️ Next") and st.session_state.current_pos < len(st.session_state.unlabeled_indices)-1:
-        st.session_state.current_pos += 1
-        st.rerun()
+    st.button("⏭️ Next", on_click=go_next)
+
+# --- Deferred Image Render ---
+show_image(image_future, image_slot)
 
 # --- Debug Panel ---
 st.sidebar.subheader("Validation Info")
 st.sidebar.write(f"Current CSV Index: {csv_idx}")
-st.sidebar.write(f"Current Image Name: {row['Image_Name']}")
+st.sidebar.write(f"Current Image Name: {img_name}")
+st.sidebar.write(f"Image Size: {img_size[0]}×{img_size[1]} px")
 st.sidebar.write(f"Total Images: {len(GT_Pneumothorax)}")
 st.sidebar.write(f"Unlabeled Remaining: {len(st.session_state.unlabeled_indices)}")
+st.sidebar.write(f"Pending Sync: {len(st.session_state.pending_edits)}")
+st.sidebar.write(f"CSV Version: {st.session_state.last_sha[:7]}")
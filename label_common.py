@@ -0,0 +1,103 @@
+"""Helpers shared by the labeling apps (apl.py and app1.py)."""
+import streamlit as st
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pac
+from PIL import Image
+import os
+import io
+import concurrent.futures
+
+DISPLAY_SIZE = (1024, 1024)  # Images are shrunk to fit this box for display
+PREFETCH_AHEAD = 2  # Upcoming images decoded in the background
+IMG_CACHE_SIZE = 4  # Image futures kept per session (current + prefetched)
+LABEL_COLUMNS = ["Pneumothorax_Type", "Pneumothorax_Size", "Affected_Side", "Label_Flag", "Drop"]
+LABEL_CATEGORIES = {  # Allowed values of the text label columns, registered up front
+    "Pneumothorax_Type": ["Simple", "Tension"],
+    "Pneumothorax_Size": ["Small", "Large"],
+    "Affected_Side": ["Right", "Left"],
+    "Drop": ["True", "False"],
+}
+
+# --- CSV Parsing ---
+# pyarrow parses the CSV multi-threaded into columnar buffers; the known columns skip type inference
+CSV_CONVERT_OPTIONS = pac.ConvertOptions(
+    column_types={"Index": pa.int32(), "Image_Name": pa.string()},
+    strings_can_be_null=True,  # empty cells become NaN, as with pd.read_csv
+)
+
+def coerce_label_columns(df):
+    """Give the label columns compact dtypes in place and return ``df``."""
+    # Small-cardinality label columns become categoricals with every allowed value registered
+    # up front, so a save never has to add a category or upcast a column; an int8
+    # Label_Flag also lets later scans work on a compact array
+    for col, categories in LABEL_CATEGORIES.items():
+        values = df[col].astype("string") if col in df else pd.Series(pd.NA, index=df.index, dtype="string")
+        extra = [v for v in values.dropna().unique() if v not in categories]  # keep unexpected values
+        df[col] = pd.Categorical(values, categories=categories + extra)
+    df["Label_Flag"] = pd.to_numeric(df["Label_Flag"], errors="coerce").fillna(0).astype(np.int8)
+    return df
+
+# --- Image Decoding ---
+# Decode each image once per file version and downscale it before it is sent to the browser
+@st.cache_resource(show_spinner=False, max_entries=64)
+def _decode_for_display(path, mtime):
+    """Return display-ready JPEG bytes for the image at ``path``."""
+    with Image.open(path) as im:
+        # JPEG only: libjpeg scales by 1/2, 1/4 or 1/8 inside the DCT, so a large
+        # X-ray is never decoded at full resolution
+        im.draft("L", DISPLAY_SIZE)
+        if im.mode.startswith("I"):
+            # 16-bit grayscale: stretch the values actually used to 0-255; X-rays exported
+            # from DICOM often store 12 bits, so a fixed /256 would render them near black
+            im = im.convert("I")
+            lo, hi = im.getextrema()
+            im = im.point(lambda v: (v - lo) * (255 / max(hi - lo, 1))).convert("L")
+        # thumbnail() pre-shrinks by an integer factor, so BILINEAR looks the same as LANCZOS here
+        im.thumbnail(DISPLAY_SIZE, Image.Resampling.BILINEAR)
+        if im.mode not in ("L", "RGB"):
+            im = im.convert("RGB")
+        buf = io.BytesIO()
+        im.save(buf, "JPEG", quality=85, progressive=True)
+    return buf.getvalue()
+
+# PIL releases the GIL while decoding, so decodes overlap with building the page
+@st.cache_resource
+def _get_executor():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+def get_image_future(path):
+    """Return a future for the display bytes of ``path``, submitting the decode if needed.
+
+    Futures are kept in a small LRU at ``st.session_state.img_cache`` (an OrderedDict).
+    """
+    key = (path, os.path.getmtime(path))
+    cache = st.session_state.img_cache
+    if key in cache:
+        cache.move_to_end(key)
+    else:
+        cache[key] = _get_executor().submit(_decode_for_display, *key)
+        while len(cache) > IMG_CACHE_SIZE:
+            cache.popitem(last=False)
+    return cache[key]
+
+def prefetch_images(images_folder, image_names):
+    """Start decoding upcoming images in the background while the user labels the current one."""
+    for name in image_names:
+        path = os.path.join(images_folder, name)
+        if os.path.exists(path):
+            get_image_future(path)
+
+def start_image(images_folder, name, upcoming):
+    """Start decoding image ``name`` and the ``upcoming`` names; return (future, placeholder)."""
+    # Start the decode now but only wait for it at the end of the script, once the widgets are built
+    future = get_image_future(os.path.join(images_folder, name))
+    slot = st.empty()
+    # Decode the next images in the background while this one is being labeled
+    prefetch_images(images_folder, upcoming)
+    return future, slot
+
+def show_image(future, slot, caption=None):
+    """Fill the placeholder from start_image(); by now the background decode has usually finished."""
+    slot.image(future.result(), caption=caption, width="stretch")